@@ -17,10 +17,12 @@ A Model Context Protocol server that provides Python code execution
 via an isolated IPython kernel process.
 """
 
-import asyncio
+import functools
+import itertools
 import time
 import uuid
 import html
+from queue import Empty
 from typing import Optional
 
 from mcp.server.fastmcp import FastMCP, Image
@@ -33,62 +35,11 @@ HIGHLIGHT_JS = (STATIC_DIR / "highlight.min.js").read_text()
 HIGHLIGHT_CSS = (STATIC_DIR / "github-dark.min.css").read_text()
 HIGHLIGHT_PYTHON = (STATIC_DIR / "python.min.js").read_text()
 
-IMPORTS = (
-    "import numpy as np\n" "import pandas as pd\n" "import matplotlib.pyplot as plt\n"
-)
-
-mcp = FastMCP(
-    "PyKernel",
-    instructions=(
-        "PyKernel allows an agent to run python code in a jupyter kernel without writing "
-        "out a python file.\n Use this for quick analysis when the user has not explicitly "
-        "asked to create a python file. Written by Douwe Osinga. The kernel persists between "
-        "calls, but could restart without warning. If that happens, reinitialize it as needed.\n\n"
-        "The kernel comes preconfigured with:\n"
-        f"{IMPORTS}\n"
-        "DO NOT REPRINT THE CODE YOU SEND AFTER EXECUTION!"
-    ),
-)
-
-
-class KernelState:
-    def __init__(self):
-        self.km: Optional[AsyncKernelManager] = None
-        self.kc = None
-        self.kernel_id = str(uuid.uuid4())
-        self.start_time = time.time()
-        self.session_api_url: Optional[str] = None
-        self.session_id: Optional[str] = None
-
-    def get_uptime(self) -> float:
-        return time.time() - self.start_time
-
-    async def ensure_started(self):
-        if self.km is None:
-            self.km = AsyncKernelManager()
-            await self.km.start_kernel()
-            self.kc = self.km.client()
-            self.kc.start_channels()
-            await self.kc.wait_for_ready()
-            self.kc.execute(IMPORTS)
-            self.kc.execute("%matplotlib inline")
-            self.kernel_id = str(uuid.uuid4())
-            self.start_time = time.time()
-
-
-state = KernelState()
-
-
-async def html_result(code, error_text, output_text, images):
-    images_html = ""
-    if images:
-        images_html = '<div style="margin-bottom: 16px;">'
-        images_html += '<div style="margin-bottom: 8px; font-weight: 600; color: #4ec9b0; font-size: 13px;">Images:</div>'
-        for img_data in images:
-            images_html += f'<img src="data:image/png;base64,{img_data}" style="max-width: 100%; border-radius: 4px; margin-bottom: 8px;">'
-        images_html += "</div>"
+# Resource URIs only need to be unique per server process.
+RUN_ID = uuid.uuid4().hex[:8]
+_uri_seq = itertools.count()
 
-    ui_html = f"""
+HTML_HEAD = f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -110,51 +61,27 @@ async def html_result(code, error_text, output_text, images):
             }}
         </style>
     </head>
-    <body>
-    <div id="content" style="background: #1e1e1e; color: #d4d4d4; padding: 20px; border-radius: 8px;">
-        <div style="margin-bottom: 16px;">
-            <div style="margin-bottom: 8px; font-weight: 600; color: #4ec9b0; font-size: 13px;">Code:</div>
-            <div style="border-left: 3px solid #569cd6;">
-                <pre><code class="language-python">{html.escape(code)}</code></pre>
-            </div>
-        </div>
-        
-        {images_html}
+    <body>"""
 
-        {f'''<div style="margin-bottom: 16px;">
-            <div style="margin-bottom: 8px; font-weight: 600; color: #4ec9b0; font-size: 13px;">Output:</div>
-            <div style="border-left: 3px solid #4ec9b0;">
-                <pre style="background: #252526; padding: 12px; border-radius: 4px; overflow-x: auto; margin: 0;"><code style="font-family: 'Monaco', 'Menlo', 'Consolas', monospace; font-size: 13px; line-height: 1.5;">{html.escape(output_text)}</code></pre>
-            </div>
-        </div>''' if output_text else ''}
-
-        {f'''<div style="margin-bottom: 16px;">
-            <div style="margin-bottom: 8px; font-weight: 600; color: #f48771; font-size: 13px;">Errors:</div>
-            <div style="border-left: 3px solid #f48771;">
-                <pre style="background: #3b1f1f; padding: 12px; border-radius: 4px; overflow-x: auto; margin: 0;"><code class="language-python" style="font-family: 'Monaco', 'Menlo', 'Consolas', monospace; font-size: 13px; line-height: 1.5; color: #f48771;">{html.escape(error_text)}</code></pre>
-            </div>
-        </div>''' if error_text else ''}
-
-        {'''<div style="color: #4ec9b0; font-size: 13px;">✓ Code executed successfully</div>''' if not output_text and not error_text else ''}
-    </div>
+HTML_TAIL = """
     <script>
         // Apply syntax highlighting
         hljs.highlightAll();
 
-        function notifySize() {{
+        function notifySize() {
             const content = document.getElementById('content');
             const height = content.scrollHeight + 40;
-            window.parent.postMessage({{
+            window.parent.postMessage({
                 type: 'ui-size-change',
-                payload: {{ height: height, width: window.innerWidth }}
-            }}, '*');
-        }}
+                payload: { height: height, width: window.innerWidth }
+            }, '*');
+        }
 
-        window.addEventListener('load', () => {{
+        window.addEventListener('load', () => {
             notifySize();
             // Re-notify after highlighting completes
             setTimeout(notifySize, 100);
-        }});
+        });
 
         window.addEventListener('resize', notifySize);
         notifySize();
@@ -162,7 +89,172 @@ async def html_result(code, error_text, output_text, images):
     </body>
     </html>
     """
-    return ui_html
+
+CONTENT_TEMPLATE = """
+    <div id="content" style="background: #1e1e1e; color: #d4d4d4; padding: 20px; border-radius: 8px;">
+        <div style="margin-bottom: 16px;">
+            <div style="margin-bottom: 8px; font-weight: 600; color: #4ec9b0; font-size: 13px;">Code:</div>
+            <div style="border-left: 3px solid #569cd6;">
+                <pre><code class="language-python">{code}</code></pre>
+            </div>
+        </div>
+        
+        {images}
+
+        {output}
+
+        {error}
+
+        {success}
+    </div>
+    """
+
+OUTPUT_SECTION = """<div style="margin-bottom: 16px;">
+            <div style="margin-bottom: 8px; font-weight: 600; color: #4ec9b0; font-size: 13px;">Output:</div>
+            <div style="border-left: 3px solid #4ec9b0;">
+                <pre style="background: #252526; padding: 12px; border-radius: 4px; overflow-x: auto; margin: 0;"><code style="font-family: 'Monaco', 'Menlo', 'Consolas', monospace; font-size: 13px; line-height: 1.5;">{output}</code></pre>
+            </div>
+        </div>"""
+
+ERROR_SECTION = """<div style="margin-bottom: 16px;">
+            <div style="margin-bottom: 8px; font-weight: 600; color: #f48771; font-size: 13px;">Errors:</div>
+            <div style="border-left: 3px solid #f48771;">
+                <pre style="background: #3b1f1f; padding: 12px; border-radius: 4px; overflow-x: auto; margin: 0;"><code class="language-python" style="font-family: 'Monaco', 'Menlo', 'Consolas', monospace; font-size: 13px; line-height: 1.5; color: #f48771;">{error}</code></pre>
+            </div>
+        </div>"""
+
+SUCCESS_SECTION = (
+    '<div style="color: #4ec9b0; font-size: 13px;">✓ Code executed successfully</div>'
+)
+
+# Cells that print nothing, raise nothing and plot nothing only need the code filled in.
+EMPTY_CONTENT_TEMPLATE = CONTENT_TEMPLATE.format(
+    code="{code}", images="", output="", error="", success=SUCCESS_SECTION
+)
+
+IMPORTS = (
+    "import numpy as np\n" "import pandas as pd\n" "import matplotlib.pyplot as plt\n"
+)
+
+mcp = FastMCP(
+    "PyKernel",
+    instructions=(
+        "PyKernel allows an agent to run python code in a jupyter kernel without writing "
+        "out a python file.\n Use this for quick analysis when the user has not explicitly "
+        "asked to create a python file. Written by Douwe Osinga. The kernel persists between "
+        "calls, but could restart without warning. If that happens, reinitialize it as needed.\n\n"
+        "The kernel comes preconfigured with:\n"
+        f"{IMPORTS}\n"
+        "DO NOT REPRINT THE CODE YOU SEND AFTER EXECUTION!"
+    ),
+)
+
+
+class KernelState:
+    def __init__(self):
+        self.km: Optional[AsyncKernelManager] = None
+        self.kc = None
+        self.kernel_id = str(uuid.uuid4())
+        self.start_time = time.monotonic()
+        self.session_api_url: Optional[str] = None
+        self.session_id: Optional[str] = None
+
+    def get_uptime(self) -> float:
+        return time.monotonic() - self.start_time
+
+    async def ensure_started(self):
+        if self.km is None:
+            self.km = AsyncKernelManager()
+            await self.km.start_kernel()
+            self.kc = self.km.client()
+            self.kc.start_channels()
+            await self.prepare()
+
+    async def restart(self):
+        if self.km is None:
+            await self.ensure_started()
+            return
+        # Restart only the kernel process; the manager and the client with its
+        # channels stay connected to the same ports.
+        await self.km.restart_kernel()
+        await self.prepare()
+
+    async def prepare(self):
+        await self.kc.wait_for_ready()
+        msg_id = self.kc.execute(IMPORTS + "%matplotlib inline\n")
+        await self.wait_for_idle(msg_id)
+        self.kernel_id = str(uuid.uuid4())
+        self.start_time = time.monotonic()
+
+    async def read_iopub_batch(self, msg_id: str, timeout: float) -> list[dict]:
+        """Wait for iopub traffic, then drain whatever else is already queued.
+
+        Only messages that are replies to msg_id get fully deserialized; for
+        anything else just the parent header frame is unpacked and the rest is
+        dropped.
+        """
+        socket = self.kc.iopub_channel.socket
+        session = self.kc.session
+        if not await socket.poll(int(timeout * 1000)):
+            raise Empty
+        batch = []
+        while await socket.poll(0):
+            _, frames = session.feed_identities(await socket.recv_multipart())
+            if session.unpack(frames[2]).get("msg_id") == msg_id:
+                batch.append(session.deserialize(frames))
+        return batch
+
+    async def drain_iopub(self):
+        """Drop iopub messages left over from earlier requests, unparsed."""
+        socket = self.kc.iopub_channel.socket
+        while await socket.poll(0):
+            await socket.recv_multipart()
+
+    async def wait_for_idle(self, msg_id: str, timeout: float = 30.0):
+        try:
+            while True:
+                for msg in await self.read_iopub_batch(msg_id, timeout):
+                    if (
+                        msg["header"]["msg_type"] == "status"
+                        and msg["content"]["execution_state"] == "idle"
+                    ):
+                        return
+        except Empty:
+            pass
+
+
+state = KernelState()
+
+
+@functools.lru_cache(maxsize=128)
+def escape_code(code: str) -> str:
+    return html.escape(code)
+
+
+def images_html(images):
+    if not images:
+        return ""
+    html_parts = [
+        '<div style="margin-bottom: 16px;">'
+        '<div style="margin-bottom: 8px; font-weight: 600; color: #4ec9b0; font-size: 13px;">Images:</div>'
+    ]
+    for img_data in images:
+        html_parts.append(
+            f'<img src="data:image/png;base64,{img_data}" style="max-width: 100%; border-radius: 4px; margin-bottom: 8px;">'
+        )
+    html_parts.append("</div>")
+    return "".join(html_parts)
+
+
+def ui_resource(call_id: str, ui_html: str) -> EmbeddedResource:
+    return EmbeddedResource(
+        type="resource",
+        resource={
+            "uri": f"ui://pykernel_mcp/result-{call_id}",
+            "mimeType": "text/html",
+            "text": ui_html,
+        },
+    )
 
 
 @mcp.tool()
@@ -173,40 +265,54 @@ async def execute_python(code: str) -> list[TextContent | EmbeddedResource]:
     need to repeat either of those things unless it fits further explanations.
     """
     await state.ensure_started()
+    await state.drain_iopub()
 
     msg_id = state.kc.execute(code)
 
     outputs = []
+    stream_chunks = []
+    stream_name = None
     errors = []
     images = []
 
-    while True:
+    idle = False
+    while not idle:
         try:
-            msg = await asyncio.wait_for(state.kc.get_iopub_msg(), timeout=30.0)
-
-            if msg["parent_header"].get("msg_id") != msg_id:
-                continue
+            batch = await state.read_iopub_batch(msg_id, timeout=30.0)
+        except Empty:
+            errors.append("Execution timed out after 30 seconds")
+            break
 
+        for msg in batch:
             content = msg["content"]
             msg_type = msg["header"]["msg_type"]
 
             if msg_type == "stream":
-                outputs.append(content["text"])
+                # Consecutive messages on one stream are pieces of a single run.
+                if stream_chunks and content["name"] != stream_name:
+                    outputs.append("".join(stream_chunks))
+                    stream_chunks.clear()
+                stream_name = content["name"]
+                stream_chunks.append(content["text"])
             elif msg_type == "display_data":
                 if "image/png" in content["data"]:
                     images.append(content["data"]["image/png"])
             elif msg_type == "execute_result":
+                if stream_chunks:
+                    outputs.append("".join(stream_chunks))
+                    stream_chunks.clear()
                 outputs.append(content["data"].get("text/plain", ""))
             elif msg_type == "error":
                 errors.extend(content["traceback"])
             elif msg_type == "status" and content["execution_state"] == "idle":
+                idle = True
                 break
 
-        except asyncio.TimeoutError:
-            errors.append("Execution timed out after 30 seconds")
-            break
+    if stream_chunks:
+        outputs.append("".join(stream_chunks))
 
     result_parts = []
+    call_id = f"{RUN_ID}-{next(_uri_seq)}"
 
     uptime = state.get_uptime()
     result_parts.append(
@@ -220,50 +326,57 @@ async def execute_python(code: str) -> list[TextContent | EmbeddedResource]:
         TextContent(type="text", text=f"**Executed:**\n```python\n{code}\n```")
     )
 
-    for img_data in images:
+    if not outputs and not errors and not images:
+        result_parts.append(
+            TextContent(type="text", text="✓ Code executed successfully")
+        )
+        ui_html = (
+            HTML_HEAD + EMPTY_CONTENT_TEMPLATE.format(code=escape_code(code)) + HTML_TAIL
+        )
+        result_parts.append(ui_resource(call_id, ui_html))
+        return result_parts
+
+    # ipykernel already sends image/png as base64 text, which is exactly what
+    # the resource blob expects, so the same string is shared with the HTML.
+    for i, img_data in enumerate(images):
         result_parts.append(
             EmbeddedResource(
                 type="resource",
                 resource={
-                    "uri": f"image://pykernel/{uuid.uuid4()}.png",
+                    "uri": f"image://pykernel/{call_id}-{i}.png",
                     "mimeType": "image/png",
                     "blob": img_data,
                 },
             )
         )
 
+    html_sections = {
+        "code": escape_code(code),
+        "images": images_html(images),
+        "output": "",
+        "error": "",
+        "success": "",
+    }
+
     if outputs:
         output_text = "\n".join(outputs)
         result_parts.append(
             TextContent(type="text", text=f"**Output:**\n```\n{output_text}\n```")
         )
+        html_sections["output"] = OUTPUT_SECTION.format(output=html.escape(output_text))
 
     if errors:
         error_text = "\n".join(errors)
         result_parts.append(
             TextContent(type="text", text=f"**Errors:**\n```python\n{error_text}\n```")
         )
+        html_sections["error"] = ERROR_SECTION.format(error=html.escape(error_text))
 
-    if not outputs and not errors and not images:
-        result_parts.append(
-            TextContent(type="text", text="✓ Code executed successfully")
-        )
-
-    output_text = "\n".join(outputs) if outputs else ""
-    error_text = "\n".join(errors) if errors else ""
+    if not outputs and not errors:
+        html_sections["success"] = SUCCESS_SECTION
 
-    ui_html = await html_result(code, error_text, output_text, images)
-
-    result_parts.append(
-        EmbeddedResource(
-            type="resource",
-            resource={
-                "uri": f"ui://pykernel_mcp/result-{uuid.uuid4()}",
-                "mimeType": "text/html",
-                "text": ui_html,
-            },
-        )
-    )
+    ui_html = HTML_HEAD + CONTENT_TEMPLATE.format_map(html_sections) + HTML_TAIL
+    result_parts.append(ui_resource(call_id, ui_html))
 
     return result_parts
 
@@ -277,12 +390,7 @@ async def install_package(package: str) -> list[TextContent | EmbeddedResource]:
 @mcp.tool()
 async def restart_kernel() -> str:
     """Restart the Python kernel, clearing all state."""
-    if state.km is not None:
-        await state.km.shutdown_kernel()
-        state.km = None
-        state.kc = None
-
-    await state.ensure_started()
+    await state.restart()
     return f"Kernel restarted. New ID: {state.kernel_id}"
 
 